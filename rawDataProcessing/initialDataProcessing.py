@@ -1,17 +1,26 @@
 # This file will attempt to make a graph out of the municipalities in Mexico using the municipalities.json file
 
-import json
+import orjson
+import ijson
 import csv
 import heapq
-import math
+from math import sin
 import folium
-import functools
+import numpy as np
+from dataclasses import dataclass, field
+from pathlib import Path
+from scipy.spatial import cKDTree
 
 MAX_EDGES = 10 # max number of connected municipalities
 MAX_DISTANCE = 100 # miles (all distances are in miles unless otherwise specified)
+EARTH_RADIUS = 6371 # kilometers
+# Straight line distance through the unit sphere for MAX_DISTANCE (padded slightly so rounding never drops a candidate)
+MAX_DISTANCE_CHORD = 2 * sin(MAX_DISTANCE * 1.609 / EARTH_RADIUS / 2) * (1 + 1e-9)
 
 
 class MunicipalityEdge:
+	__slots__ = ('fromMuniCode', 'toMuniCode', 'distance')
+
 	def __init__(self, fromMuniCode, toMuniCode, distance=None):
 		self.fromMuniCode = fromMuniCode
 		self.toMuniCode = toMuniCode
@@ -29,6 +38,8 @@ class MunicipalityEdge:
 
 
 class Municipality:
+	__slots__ = ('name', 'state', 'code', 'lat', 'lon', 'hasSupercharger', '_neighbors', 'edges')
+
 	def __init__(self, name, state, code, lat, lon, hasSupercharger=False, edges=None):
 		self.name = name
 		self.state = state
@@ -57,13 +68,103 @@ class Municipality:
 				heapq.heappop(self.edges)
 
 
+# Structure of arrays view of the municipalities, every column is indexed by the same 0..N-1 ordinal
+@dataclass
+class MunicipalityTable:
+	names: np.ndarray
+	states: np.ndarray
+	codes: np.ndarray
+	lat: np.ndarray
+	lon: np.ndarray
+	hasSupercharger: np.ndarray
+	codeToIndex: dict[str, int]
+	# Each undirected edge is stored once as (edgeLow, edgeHigh, edgeDistance) with edgeLow < edgeHigh,
+	# the reverse direction is only materialized when traversing or serializing
+	edgeLow: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int32))
+	edgeHigh: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int32))
+	edgeDistance: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.float64))
+	# Both directions CSR style, taken as-is from the graph file when loading, otherwise built from the edges above
+	# the first time it is needed
+	_adjacency: tuple[np.ndarray, np.ndarray, np.ndarray] | None = field(default=None, init=False, repr=False)
+
+	def __len__(self):
+		return len(self.codes)
+
+	@staticmethod
+	def fromMunicipalities(municipalities: list[Municipality]):
+		table = MunicipalityTable(
+			np.array([muni.name for muni in municipalities]),
+			np.array([muni.state for muni in municipalities]),
+			np.array([muni.code for muni in municipalities]),
+			np.array([muni.lat for muni in municipalities], dtype=np.float64),
+			np.array([muni.lon for muni in municipalities], dtype=np.float64),
+			np.array([muni.hasSupercharger for muni in municipalities], dtype=bool),
+			{muni.code: index for index, muni in enumerate(municipalities)})
+		# Keep each municipality's own edge list (order and distance values) as the adjacency,
+		# so a graph file that is loaded and saved again comes back unchanged
+		edges = [edge for muni in municipalities for edge in muni.edges]
+		offsets = np.zeros(len(table) + 1, dtype=np.int64)
+		np.cumsum([len(muni.edges) for muni in municipalities], out=offsets[1:])
+		adjacency = (
+			offsets,
+			np.array([table.codeToIndex[edge.toMuniCode] for edge in edges], dtype=np.int32),
+			np.array([edge.distance for edge in edges]) if edges else np.zeros(0, dtype=np.float64))
+
+		# Graph files list every edge from both sides, both sides have to agree on the distance
+		undirected: dict[tuple[int, int], float] = {}
+		for muni in municipalities:
+			for edge in muni.edges:
+				fromIndex, toIndex = table.codeToIndex[edge.fromMuniCode], table.codeToIndex[edge.toMuniCode]
+				pair = (min(fromIndex, toIndex), max(fromIndex, toIndex))
+				if undirected.setdefault(pair, edge.distance) != edge.distance:
+					raise ValueError("Edge " + edge.fromMuniCode + " <-> " + edge.toMuniCode + " has a different distance on each side")
+		table.setEdges([low for low, _ in undirected], [high for _, high in undirected], list(undirected.values()))
+		table._adjacency = adjacency
+		return table
+
+	def setEdges(self, edgeLow: list[int], edgeHigh: list[int], edgeDistance: list[float]):
+		self.edgeLow = np.array(edgeLow, dtype=np.int32)
+		self.edgeHigh = np.array(edgeHigh, dtype=np.int32)
+		self.edgeDistance = np.array(edgeDistance) if edgeDistance else np.zeros(0, dtype=np.float64)
+		self._adjacency = None
+
+	def neighborsOf(self, index: int) -> list[tuple[int, float]]:
+		# (neighbor, distance) for every edge touching the municipality
+		offsets, neighbor, distance = self.getAdjacency()
+		start, end = offsets[index], offsets[index+1]
+		return list(zip(neighbor[start:end].tolist(), distance[start:end].tolist()))
+
+	def getAdjacency(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+		# Both directions CSR style, the edges of municipality i are neighbor[offsets[i]:offsets[i+1]]
+		if self._adjacency is None:
+			edgeFrom = np.column_stack((self.edgeLow, self.edgeHigh)).ravel()
+			edgeTo = np.column_stack((self.edgeHigh, self.edgeLow)).ravel()
+			# Group by the starting municipality, keeping the order the edges were added in
+			order = np.argsort(edgeFrom, kind='stable')
+			offsets = np.zeros(len(self) + 1, dtype=np.int64)
+			np.cumsum(np.bincount(edgeFrom, minlength=len(self)), out=offsets[1:])
+			self._adjacency = (offsets, edgeTo[order], np.repeat(self.edgeDistance, 2)[order])
+		return self._adjacency
+
+
 def municipalityDictSerializer(obj):
-	if isinstance(obj, Municipality):
-		dictionary = obj.__dict__
-		del dictionary['_neighbors']
-		return dictionary
-	if isinstance(obj, MunicipalityEdge):
-		return obj.__dict__
+	if isinstance(obj, MunicipalityTable):
+		# Rebuild the code -> municipality format used by the graph files
+		names, states, codes = obj.names.tolist(), obj.states.tolist(), obj.codes.tolist()
+		lat, lon, hasSupercharger = obj.lat.tolist(), obj.lon.tolist(), obj.hasSupercharger.tolist()
+		edgeOffsets, edgeTo, edgeDistance = (array.tolist() for array in obj.getAdjacency())
+		return {codes[i]: {
+			'name': names[i],
+			'state': states[i],
+			'code': codes[i],
+			'lat': lat[i],
+			'lon': lon[i],
+			'hasSupercharger': hasSupercharger[i],
+			'edges': [{
+				'fromMuniCode': codes[i],
+				'toMuniCode': codes[edgeTo[e]],
+				'distance': edgeDistance[e]} for e in range(edgeOffsets[i], edgeOffsets[i+1])]
+		} for i in range(len(codes))}
 	raise TypeError("Type not serializable")
 
 
@@ -71,22 +172,21 @@ def cleanMunicipalities():
 	print("Opening municipalities.json")
 	municipalities = None
 
-	with open("municipalities.json") as file:
-		# Remove the geo_shape keys
-		municipalities = json.load(file)
-		for municipality in municipalities:
+	with open("municipalities.json", 'rb') as file:
+		# Stream the municipalities one at a time, removing the (very large) geo_shape keys as they come in
+		municipalities = []
+		for municipality in ijson.items(file, 'item', use_float=True):
 			del municipality['geo_shape']
+			municipalities.append(municipality)
 
 	# Save the municipalities as a json file
-	with open('cleanMunicipalities.json', 'w') as file:
-		json.dump(municipalities, file)
+	Path('cleanMunicipalities.json').write_bytes(orjson.dumps(municipalities))
 
 	print("Municipalities read in, cleaned, and saved.")
 
 
 def loadCleanMunicipalities():
-	with open('cleanMunicipalities.json') as file:
-		return json.load(file)
+	return orjson.loads(Path('cleanMunicipalities.json').read_bytes())
 
 
 def loadCleanSuperchargers():
@@ -96,6 +196,16 @@ def loadCleanSuperchargers():
 		return [row for row in reader]
 
 
+def parseRawMunicipality(municipality) -> Municipality:
+	# Build a Municipality from one entry of the cleaned municipalities.json file
+	return Municipality(
+		municipality['mun_name'][0], 
+		municipality['sta_name'][0], 
+		municipality['mun_code'][0], 
+		municipality['geo_point_2d']['lat'], 
+		municipality['geo_point_2d']['lon'])
+
+
 def saveMunicipalityWithSuperchargers():
 	# For each supercharger, determine if its city is in the municipalities.json file
 	municipalities = loadCleanMunicipalities()
@@ -108,26 +218,17 @@ def saveMunicipalityWithSuperchargers():
 
 	# Iterate over the municipalities and add them to the dictionary
 	for municipality in municipalities:
-		dictLookup = municipality['sta_name'][0]+"_"+municipality['mun_name'][0]
-		if dictLookup in nameToMunicipality:
-			# Append it to the list of municipalities with the same name
-			nameToMunicipality[dictLookup].append(Municipality(
-				municipality['mun_name'][0], 
-				municipality['sta_name'][0], 
-				municipality['mun_code'][0], 
-				municipality['geo_point_2d']['lat'], 
-				municipality['geo_point_2d']['lon']))
-		else: nameToMunicipality[dictLookup] = [Municipality(
-			municipality['mun_name'][0], 
-			municipality['sta_name'][0], 
-			municipality['mun_code'][0], 
-			municipality['geo_point_2d']['lat'],
-			municipality['geo_point_2d']['lon'])]
+		muni = parseRawMunicipality(municipality)
+		# Append it to the list of municipalities with the same name
+		nameToMunicipality.setdefault(muni.state+"_"+muni.name, []).append(muni)
+
+	# Decode each distinct (escaped) supercharger location once
+	escapedMunicipalities = [supercharger['State']+"_"+supercharger['Municipality'] for supercharger in superchargers]
+	decodedMunicipalities = {escaped: escaped.encode('utf-8').decode('unicode-escape') for escaped in set(escapedMunicipalities)}
 
 	# Iterate over the superchargers and see how many of their cities are in the municipalities
-	for supercharger in superchargers:
-		escapedMunicipality = supercharger['State']+"_"+supercharger['Municipality']
-		decodedMunicipality = escapedMunicipality.encode('utf-8').decode('unicode-escape')
+	for escapedMunicipality in escapedMunicipalities:
+		decodedMunicipality = decodedMunicipalities[escapedMunicipality]
 		if decodedMunicipality not in nameToMunicipality:
 			print("Bad supercharger location: ", decodedMunicipality)
 			continue
@@ -150,87 +251,117 @@ def saveMunicipalityWithSuperchargers():
 			codeToMunicipality[municipality.code] = municipality
 	print("Total codes:", len(codeToMunicipality.items()))
 
-	# Write the municipalities (with codes) to a JSON file
-	with open('cleanMunicipalitiesWithSuperchargers.json', 'w') as file:
-		json.dump(codeToMunicipality, file, default=municipalityDictSerializer)
+	# Write the municipalities (with codes) to a JSON file, building the plain dicts up front rather than per object callbacks
+	serializable = {code: {
+		'name': muni.name,
+		'state': muni.state,
+		'code': muni.code,
+		'lat': muni.lat,
+		'lon': muni.lon,
+		'hasSupercharger': muni.hasSupercharger,
+		'edges': []} for code, muni in codeToMunicipality.items()} # edges are only added later, in addEdgesToMunicipalities
+	Path('cleanMunicipalitiesWithSuperchargers.json').write_bytes(orjson.dumps(serializable))
 
 
 def getMunicipalityCodeToSuperchargerStatus():
 	# Read each code:Municipality object from the JSON file
-	with open('cleanMunicipalitiesWithSuperchargers.json') as file:
-		obj = json.load(file)
-		# Map each value to a Municipality object
-		return {code: Municipality(**value) for code, value in obj.items()}
+	obj = orjson.loads(Path('cleanMunicipalitiesWithSuperchargers.json').read_bytes())
+	# Map each value to a Municipality object
+	return {code: Municipality(**value) for code, value in obj.items()}
 
 
-@functools.lru_cache(maxsize=None)
-def getDistanceBetweenMunicipalities(muni1, muni2):
-	# Use the Haversine formula to get the distance between two points
-	lat1, lon1 = muni1.lat, muni1.lon
-	lat2, lon2 = muni2.lat, muni2.lon
+def getDistancesBetweenPoints(lat1, lon1, lat2, lon2) -> np.ndarray:
+	# Vectorized Haversine formula, the arguments broadcast against each other like any NumPy ufunc
+	dLat = np.radians(lat2 - lat1)
+	dLon = np.radians(lon2 - lon1)
+	lat1 = np.radians(lat1)
+	lat2 = np.radians(lat2)
 
-	R = 6371 # meters
-	dLat = math.radians(lat2 - lat1)
-	dLon = math.radians(lon2 - lon1)
-	lat1 = math.radians(lat1)
-	lat2 = math.radians(lat2)
-
-	a = math.sin(dLat/2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dLon/2) ** 2
-	c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-	distance = R * c
+	a = np.sin(dLat/2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dLon/2) ** 2
+	c = 2 * np.arcsin(np.sqrt(a))
 
 	# Convert to miles
-	return distance / 1.609
+	return EARTH_RADIUS * c / 1.609
+
+
+def getUnitSphereCoordinates(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+	# Project each (lat, lon) onto the unit sphere, the straight line (chord) distance between two
+	# points grows monotonically with their great-circle distance so nearest neighbors are preserved
+	lat, lon = np.radians(lat), np.radians(lon)
+	return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def getNearestCandidates(tree: cKDTree, points: np.ndarray, lat: np.ndarray, lon: np.ndarray, rows: np.ndarray, k: int):
+	# Find the k closest municipalities within MAX_DISTANCE of each row, the tree prunes everything farther away.
+	# Rows with fewer than k in range are padded with index len(points) and an infinite distance
+	_, indices = tree.query(points[rows], k=k, distance_upper_bound=MAX_DISTANCE_CHORD, workers=-1)
+	found = indices < len(points)
+	safeIndices = np.where(found, indices, 0)
+	# Get the real distance of every candidate pair in one go
+	distances = getDistancesBetweenPoints(lat[rows][:, None], lon[rows][:, None], lat[safeIndices], lon[safeIndices])
+	distances = np.where(found, distances, np.inf)
+	# Order the candidates by great-circle distance itself, so near ties can't be flipped by chord rounding
+	order = np.argsort(distances, axis=1, kind='stable')
+	return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def iterRowCandidates(tree: cKDTree, points: np.ndarray, lat: np.ndarray, lon: np.ndarray, i: int,
+		distances: np.ndarray, indices: np.ndarray, neighbors: list[set[int]]):
+	# Yield (distance, index) candidates for row i closest first. Municipalities linked by an earlier row can
+	# crowd out the batched candidates, so when they run out the tree is queried again with a wider k.
+	# Candidates that were already yielded come up again, the caller skips them as neighbors.
+	rowDistances, rowIndices = distances[i], indices[i]
+	while True:
+		yield from zip(rowDistances.tolist(), rowIndices.tolist())
+		if len(rowIndices) >= len(points): return
+		k = min(MAX_EDGES+1+len(neighbors[i]), len(points))
+		rowDistances, rowIndices = getNearestCandidates(tree, points, lat, lon, np.array([i]), k)
+		rowDistances, rowIndices = rowDistances[0], rowIndices[0]
 
 
 def addEdgesToMunicipalities():
 	# Read in the municipalities with the supercharger status
-	codeToMunicipality = getMunicipalityCodeToSuperchargerStatus()
-	codeToMunicipalityValues : list[Municipality] = list(codeToMunicipality.values())
-	for i in range(len(codeToMunicipalityValues)):
-		closenessHeap = []
-		muni1 = codeToMunicipalityValues[i]
-		# Essentially gather the closest MAX_EDGES edges to each municipality
-		for j in range(len(codeToMunicipalityValues)):
-			if i == j: continue
-			muni2 = codeToMunicipalityValues[j]
-			if muni2.code in muni1._neighbors: continue
-			distance = getDistanceBetweenMunicipalities(muni1, muni2)
-			heapq.heappush(closenessHeap, (distance, muni2))
-
-		# Add the closest MAX_EDGES edges to each municipality
-		for j in range(MAX_EDGES):
-			if not closenessHeap: break
-			distance, muni2 = heapq.heappop(closenessHeap)
+	table = MunicipalityTable.fromMunicipalities(list(getMunicipalityCodeToSuperchargerStatus().values()))
+	lat, lon = table.lat, table.lon
+
+	# Find the closest MAX_EDGES municipalities (plus the municipality itself) for every municipality at once
+	points = getUnitSphereCoordinates(lat, lon)
+	tree = cKDTree(points)
+	distances, indices = getNearestCandidates(tree, points, lat, lon, np.arange(len(points)), MAX_EDGES+1)
+
+	neighbors: list[set[int]] = [set() for _ in range(len(table))]
+	edgeLow, edgeHigh, edgeDistance = [], [], []
+	for i in range(len(table)):
+		# Add the closest MAX_EDGES edges to each municipality (candidates are sorted by distance,
+		# anything past MAX_DISTANCE is infinitely far and stops the row)
+		j = 0
+		for distance, index in iterRowCandidates(tree, points, lat, lon, i, distances, indices, neighbors):
+			if index == i or index in neighbors[i]: continue
 			# Use MAX_DISTANCE / powers of 2 and 3 to limit the number of nodes with a BUNCH of edges.
 			if (j < 3 and distance > (MAX_DISTANCE/(2**j))) or (j >= 3 and distance > (MAX_DISTANCE/(3**j))): break
-			# Construct the edges
-			edgeToMuni2 = MunicipalityEdge(muni1.code, muni2.code, distance)
-			edgeToMuni1 = MunicipalityEdge(muni2.code, muni1.code, distance)
-			# Add the edge to the municipalities, remembering that it has already been visited.
-			muni1.edges.append(edgeToMuni2)
-			muni1._neighbors.add(muni2.code)
-			muni2.edges.append(edgeToMuni1)
-			muni2._neighbors.add(muni1.code)
+			# Add the edge (once, it goes both ways), remembering that it has already been visited.
+			edgeLow.append(min(i, index))
+			edgeHigh.append(max(i, index))
+			edgeDistance.append(distance)
+			neighbors[i].add(index)
+			neighbors[index].add(i)
+			j += 1
+			if j == MAX_EDGES: break
+	table.setEdges(edgeLow, edgeHigh, edgeDistance)
 
 	# Save to file allMunicipalitiesGraph.json (one level up and in a folder called graphs)
-	with open('../graphs/allMunicipalitiesGraph.json', 'w') as file:
-		json.dump(codeToMunicipality, file, default=municipalityDictSerializer)
+	Path('../graphs/allMunicipalitiesGraph.json').write_bytes(orjson.dumps(municipalityDictSerializer(table)))
 
-	return codeToMunicipality
+	return table
 
 
 def loadMunicipalitiesWithEdges():
-	with open('../graphs/allMunicipalitiesGraph.json') as file:
-		obj = json.load(file)
-		return {code: Municipality(**value) for code, value in obj.items()}
+	obj = orjson.loads(Path('../graphs/allMunicipalitiesGraph.json').read_bytes())
+	return MunicipalityTable.fromMunicipalities([Municipality(**value) for value in obj.values()])
 
 
-def testAndSaveToMap(codeToMuni, outputFile="mexicoMap.html"):
-	totalEdges = 0
-	for muni in codeToMuni.values():
-		totalEdges += len(muni.edges)
-	print("Total out edges:", totalEdges)
+def testAndSaveToMap(table: MunicipalityTable, outputFile="mexicoMap.html"):
+	print("Total out edges:", 2 * len(table.edgeDistance))
 
 	# Latitude and Longitude of Mexico City (example)
 	latitude, longitude = 19.4326, -99.1332
@@ -238,16 +369,26 @@ def testAndSaveToMap(codeToMuni, outputFile="mexicoMap.html"):
 	# Create a map centered around Mexico
 	mexico_map = folium.Map(location=[latitude, longitude], zoom_start=15)
 
-	for muni in codeToMuni.values():
-		# Add a marker to the map
-		folium.Marker([muni.lat, muni.lon], popup=muni.name).add_to(mexico_map)
-
-		# Add a line between the municipality and its neighbors
-		for edge in muni.edges:
-			# Get the neighbor
-			neighbor = codeToMuni[edge.toMuniCode]
-			# Add a line between the two municipalities
-			folium.PolyLine([[muni.lat, muni.lon], [neighbor.lat, neighbor.lon]], color="red", weight=1, opacity=0.5).add_to(mexico_map)
+	names, lat, lon = table.names.tolist(), table.lat.tolist(), table.lon.tolist()
+	# Add a marker for each municipality
+	markers = [{
+		"type": "Feature",
+		"geometry": {"type": "Point", "coordinates": [lon[i], lat[i]]},
+		"properties": {"name": names[i]}} for i in range(len(table))]
+
+	# Add a line between each pair of neighboring municipalities
+	lines = [{
+		"type": "Feature",
+		"geometry": {"type": "LineString", "coordinates": [[lon[low], lat[low]], [lon[high], lat[high]]]},
+		"properties": {}} for low, high in zip(table.edgeLow.tolist(), table.edgeHigh.tolist())]
+
+	# Add everything in two layers rather than one map element per marker / line
+	folium.GeoJson(
+		{"type": "FeatureCollection", "features": markers},
+		popup=folium.GeoJsonPopup(fields=["name"], labels=False)).add_to(mexico_map)
+	folium.GeoJson(
+		{"type": "FeatureCollection", "features": lines},
+		style_function=lambda feature: {"color": "red", "weight": 1, "opacity": 0.5}).add_to(mexico_map)
 
 	# Save the map to an HTML file
 	mexico_map.save(outputFile)
@@ -264,10 +405,10 @@ def main():
 	saveMunicipalityWithSuperchargers()
 
 	# Next, add edges between municipalities
-	codeToMuni = addEdgesToMunicipalities()
+	table = addEdgesToMunicipalities()
 
 	# Finally, make and save the map of these municipalities
-	testAndSaveToMap(codeToMuni)
+	testAndSaveToMap(table)
 	print("Data processing has succeeded.")
 
 if __name__ == '__main__':
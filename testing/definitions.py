@@ -4,6 +4,8 @@ from abc import ABC
 
 # Municipality and MunicipalityEdge classes
 class MunicipalityEdge:
+	__slots__ = ('fromMuniCode', 'toMuniCode', 'distance')
+
 	def __init__(self, fromMuniCode:str, toMuniCode:str, distance:float|int|None=None):
 		self.fromMuniCode = fromMuniCode
 		self.toMuniCode = toMuniCode
@@ -20,6 +22,8 @@ class MunicipalityEdge:
 			self.distance = distance
 
 class Municipality:
+	__slots__ = ('index', 'name', 'state', 'code', 'lat', 'lon', 'hasSupercharger', 'neighbors', 'edges')
+
 	def __init__(self, index:int, name:str, state:str, code:str, lat:float, lon:float, hasSupercharger:bool=False, edges:dict|None=None):
 		self.index = index
 		self.name = name
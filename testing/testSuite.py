@@ -31,11 +31,11 @@ TEST_CASES: list[TestCase] | None = [
 def getGraph(graphType: GraphType) -> Graph:
 	match graphType:
 		case GraphType.ALL_NODES:
-			with open('../graphs/allMunicipalitiesGraph.json') as file:
+			with open('../graphs/allMunicipalitiesGraph.json', encoding='utf-8') as file:
 				obj: dict[str, dict] = json.load(file)
 				return Graph({code: Municipality(index, **value) for index, (code, value) in enumerate(obj.items())})
 		case GraphType.EIGHT_NODES:
-			with open('../graphs/eightMunicipalitiesGraph.json') as file:
+			with open('../graphs/eightMunicipalitiesGraph.json', encoding='utf-8') as file:
 				obj: dict[str, dict] = json.load(file)
 				return Graph({code: Municipality(index, **value) for index, (code, value) in enumerate(obj.items())})
 		case _: